@@ -59,6 +59,11 @@ from bzrlib import osutils
 # from non-sockets as well.
 _MAX_READ_SIZE = osutils.MAX_SOCKET_CHUNK
 
+# Server socket media start by reading this much at a time, doubling the size
+# (up to _MAX_READ_SIZE) each time a read fills it.  Python allocates the full
+# requested size for every recv, so this keeps small requests cheap.
+_INITIAL_SOCKET_READ_SIZE = 4096
+
 def _get_protocol_factory_for_bytes(bytes):
     """Determine the right protocol factory for 'bytes'.
 
@@ -94,23 +99,24 @@ def _get_protocol_factory_for_bytes(bytes):
 def _get_line(read_bytes_func):
     """Read bytes using read_bytes_func until a newline byte.
 
-    This isn't particularly efficient, so should only be used when the
-    expected size of the line is quite short.
+    read_bytes_func is asked for one byte at a time, but may return more (a
+    socket medium returns whatever a single recv gives it).  Only the newly
+    read bytes are searched for the newline, so a line arriving in many small
+    pieces isn't rescanned from the start each time.
 
     :returns: a tuple of two strs: (line, excess)
     """
-    newline_pos = -1
-    bytes = ''
-    while newline_pos == -1:
+    chunks = []
+    while True:
         new_bytes = read_bytes_func(1)
-        bytes += new_bytes
         if new_bytes == '':
             # Ran out of bytes before receiving a complete line.
-            return bytes, ''
-        newline_pos = bytes.find('\n')
-    line = bytes[:newline_pos+1]
-    excess = bytes[newline_pos+1:]
-    return line, excess
+            return ''.join(chunks), ''
+        newline_pos = new_bytes.find('\n')
+        if newline_pos != -1:
+            chunks.append(new_bytes[:newline_pos+1])
+            return ''.join(chunks), new_bytes[newline_pos+1:]
+        chunks.append(new_bytes)
 
 
 class SmartMedium(object):
@@ -276,7 +282,10 @@ class SmartServerStreamMedium(SmartMedium):
 
         :returns: a SmartServerRequestProtocol.
         """
-        self._wait_for_bytes_with_timeout(self._client_timeout)
+        if self._push_back_buffer is None:
+            # Only wait for the client if we have no bytes of the next request
+            # already buffered.
+            self._wait_for_bytes_with_timeout(self._client_timeout)
         if self.finished:
             # We're stopping, so don't try to do any more work
             return None
@@ -358,6 +367,7 @@ class SmartServerSocketStreamMedium(SmartServerStreamMedium):
             timeout=timeout)
         sock.setblocking(True)
         self.socket = sock
+        self._read_size = _INITIAL_SOCKET_READ_SIZE
         # Get the getpeername now, as we might be closed later when we care.
         try:
             self._client_info = sock.getpeername()
@@ -401,8 +411,12 @@ class SmartServerSocketStreamMedium(SmartServerStreamMedium):
         return self._wait_on_descriptor(self.socket, timeout_seconds)
 
     def _read_bytes(self, desired_count):
-        return osutils.read_bytes_from_socket(
-            self.socket, self._report_activity)
+        bytes = osutils.read_bytes_from_socket(
+            self.socket, self._report_activity, self._read_size)
+        if len(bytes) == self._read_size and self._read_size < _MAX_READ_SIZE:
+            # The read filled our buffer, so there's probably more waiting.
+            self._read_size = min(self._read_size * 2, _MAX_READ_SIZE)
+        return bytes
 
     def terminate_due_to_error(self):
         # TODO: This should log to a server log file, but no such thing
@@ -470,6 +484,26 @@ class SmartServerPipeStreamMedium(SmartServerStreamMedium):
                 return
             protocol.accept_bytes(bytes)
 
+    def _get_line(self):
+        """See SmartMedium._get_line.
+
+        We mustn't read past the end of the line, as that may block, so the
+        generic implementation reads from the pipe one byte at a time.  Let
+        the file object's readline do that instead, which is much cheaper.
+        """
+        readline = getattr(self._in, 'readline', None)
+        if readline is None:
+            return super(SmartServerPipeStreamMedium, self)._get_line()
+        if self._push_back_buffer is None:
+            bytes = ''
+        else:
+            bytes = self._get_push_back_buffer()
+            newline_pos = bytes.find('\n')
+            if newline_pos != -1:
+                self._push_back(bytes[newline_pos+1:])
+                return bytes[:newline_pos+1]
+        return bytes + readline()
+
     def _disconnect_client(self):
         self._in.close()
         self._out.flush()
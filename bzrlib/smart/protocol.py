@@ -106,6 +106,38 @@ class Requester(object):
         raise NotImplementedError(self.set_headers)
 
 
+class _BufferedWriter(object):
+    """Collects written bytes and passes them to write_func in one call.
+
+    Subclasses write with _write_func, and call flush when the bytes written
+    so far should be sent.
+    """
+
+    BUFFER_SIZE = 1024*1024 # 1 MiB buffer before flushing
+
+    def __init__(self, write_func):
+        self._buf = []
+        self._buf_len = 0
+        self._real_write_func = write_func
+
+    def _write_func(self, bytes):
+        # TODO: Another possibility would be to turn this into an async model.
+        #       Where we let another thread know that we have some bytes if
+        #       they want it, but we don't actually block for it
+        #       Note that osutils.send_all always sends 64kB chunks anyway, so
+        #       we might just push out smaller bits at a time?
+        self._buf.append(bytes)
+        self._buf_len += len(bytes)
+        if self._buf_len > self.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._buf:
+            self._real_write_func(''.join(self._buf))
+            del self._buf[:]
+            self._buf_len = 0
+
+
 class SmartProtocolBase(object):
     """Methods common to client and server"""
 
@@ -123,21 +155,36 @@ class SmartProtocolBase(object):
         return '\n'.join(txt)
 
 
-class SmartServerRequestProtocolOne(SmartProtocolBase):
+class SmartServerRequestProtocolOne(SmartProtocolBase, _BufferedWriter):
     """Server-side encoding and decoding logic for smart version 1."""
 
     def __init__(self, backing_transport, write_func, root_client_path='/',
             jail_root=None):
+        # A response is written in several pieces; they are collected and
+        # passed to write_func together by flush.
+        _BufferedWriter.__init__(self, write_func)
         self._backing_transport = backing_transport
         self._root_client_path = root_client_path
         self._jail_root = jail_root
         self.unused_data = ''
         self._finished = False
-        self.in_buffer = ''
+        # Bytes not yet parsed, kept as a list of chunks so that a request
+        # line arriving in many pieces isn't repeatedly copied.  Use
+        # in_buffer to get them as a single str.
+        self._in_buffer_list = []
         self._has_dispatched = False
         self.request = None
         self._body_decoder = None
-        self._write_func = write_func
+
+    def _get_in_buffer(self):
+        if len(self._in_buffer_list) != 1:
+            self._in_buffer_list = [''.join(self._in_buffer_list)]
+        return self._in_buffer_list[0]
+
+    def _set_in_buffer(self, bytes):
+        self._in_buffer_list = [bytes]
+
+    in_buffer = property(_get_in_buffer, _set_in_buffer)
 
     def accept_bytes(self, bytes):
         """Take bytes, and advance the internal state machine appropriately.
@@ -146,9 +193,10 @@ class SmartServerRequestProtocolOne(SmartProtocolBase):
         """
         if not isinstance(bytes, str):
             raise ValueError(bytes)
-        self.in_buffer += bytes
+        self._in_buffer_list.append(bytes)
         if not self._has_dispatched:
-            if '\n' not in self.in_buffer:
+            # Any earlier bytes have already been checked for a newline.
+            if '\n' not in bytes:
                 # no command line yet
                 return
             self._has_dispatched = True
@@ -215,14 +263,17 @@ class SmartServerRequestProtocolOne(SmartProtocolBase):
         args = response.args
         body = response.body
         self._finished = True
-        self._write_protocol_version()
-        self._write_success_or_failure_prefix(response)
-        self._write_func(_encode_tuple(args))
-        if body is not None:
-            if not isinstance(body, str):
-                raise ValueError(body)
-            bytes = self._encode_bulk_data(body)
-            self._write_func(bytes)
+        try:
+            self._write_protocol_version()
+            self._write_success_or_failure_prefix(response)
+            self._write_func(_encode_tuple(args))
+            if body is not None:
+                if not isinstance(body, str):
+                    raise ValueError(body)
+                bytes = self._encode_bulk_data(body)
+                self._write_func(bytes)
+        finally:
+            self.flush()
 
     def _write_protocol_version(self):
         """Write any prefixes this protocol requires.
@@ -275,19 +326,30 @@ class SmartServerRequestProtocolTwo(SmartServerRequestProtocolOne):
         if (self._finished):
             raise AssertionError('response already sent')
         self._finished = True
-        self._write_protocol_version()
-        self._write_success_or_failure_prefix(response)
-        self._write_func(_encode_tuple(response.args))
-        if response.body is not None:
-            if not isinstance(response.body, str):
-                raise AssertionError('body must be a str')
-            if not (response.body_stream is None):
-                raise AssertionError(
-                    'body_stream and body cannot both be set')
-            bytes = self._encode_bulk_data(response.body)
-            self._write_func(bytes)
-        elif response.body_stream is not None:
-            _send_stream(response.body_stream, self._write_func)
+        try:
+            self._write_protocol_version()
+            self._write_success_or_failure_prefix(response)
+            self._write_func(_encode_tuple(response.args))
+            if response.body is not None:
+                if not isinstance(response.body, str):
+                    raise AssertionError('body must be a str')
+                if not (response.body_stream is None):
+                    raise AssertionError(
+                        'body_stream and body cannot both be set')
+                bytes = self._encode_bulk_data(response.body)
+                self._write_func(bytes)
+            elif response.body_stream is not None:
+                # Send the response header now, and each chunk as soon as it
+                # is produced, rather than holding a streamed body back until
+                # it ends.
+                self.flush()
+                _send_stream(response.body_stream, self._write_and_flush)
+        finally:
+            self.flush()
+
+    def _write_and_flush(self, bytes):
+        self._write_func(bytes)
+        self.flush()
 
 
 def _send_stream(stream, write_func):
@@ -427,6 +489,11 @@ class ChunkedBodyDecoder(_StatefulDecoder):
         self.chunks = collections.deque()
         self.error = False
         self.error_in_progress = None
+        # The number of bytes at the start of the in buffer that have already
+        # been decoded.  Tracking this rather than slicing them off means many
+        # small chunks arriving together don't copy the rest of the buffer
+        # for each one.
+        self._in_buffer_pos = 0
 
     def next_read_size(self):
         # Note: the shortest possible chunk is 2 bytes: '0\n', and the
@@ -457,22 +524,41 @@ class ChunkedBodyDecoder(_StatefulDecoder):
         except IndexError:
             return None
 
+    def _get_in_buffer(self):
+        if self._in_buffer_pos and len(self._in_buffer_list) > 1:
+            # New bytes have arrived and the buffer is about to be joined, so
+            # drop the bytes already decoded first.
+            self._in_buffer_list[0] = (
+                self._in_buffer_list[0][self._in_buffer_pos:])
+            self._in_buffer_pos = 0
+        return _StatefulDecoder._get_in_buffer(self)
+
+    def _consume_in_buffer(self, count):
+        """Mark count more bytes of the in buffer as decoded."""
+        self._in_buffer_pos += count
+        self._in_buffer_len -= count
+        if self._in_buffer_len == 0:
+            self._in_buffer_list = []
+            self._in_buffer_pos = 0
+
     def _extract_line(self):
         in_buf = self._get_in_buffer()
-        pos = in_buf.find('\n')
+        start = self._in_buffer_pos
+        pos = in_buf.find('\n', start)
         if pos == -1:
             # We haven't read a complete line yet, so request more bytes before
             # we continue.
             raise _NeedMoreBytes(1)
-        line = in_buf[:pos]
-        # Trim the prefix (including '\n' delimiter) from the _in_buffer.
-        self._set_in_buffer(in_buf[pos+1:])
+        line = in_buf[start:pos]
+        # Consume the line (including '\n' delimiter) from the _in_buffer.
+        self._consume_in_buffer(pos + 1 - start)
         return line
 
     def _finished(self):
-        self.unused_data = self._get_in_buffer()
+        self.unused_data = self._get_in_buffer()[self._in_buffer_pos:]
         self._in_buffer_list = []
         self._in_buffer_len = 0
+        self._in_buffer_pos = 0
         self.state_accept = self._state_accept_reading_unused
         if self.error:
             error_args = tuple(self.error_in_progress)
@@ -503,28 +589,33 @@ class ChunkedBodyDecoder(_StatefulDecoder):
             return
         else:
             self.bytes_left = int(prefix, 16)
-            self.chunk_in_progress = ''
+            # The chunk's bytes may arrive over several reads, so collect
+            # them in a list and join them once the chunk is complete.
+            self.chunk_in_progress = []
             self.state_accept = self._state_accept_reading_chunk
 
     def _state_accept_reading_chunk(self):
         in_buf = self._get_in_buffer()
-        in_buffer_len = len(in_buf)
-        self.chunk_in_progress += in_buf[:self.bytes_left]
-        self._set_in_buffer(in_buf[self.bytes_left:])
-        self.bytes_left -= in_buffer_len
+        start = self._in_buffer_pos
+        count = min(self.bytes_left, self._in_buffer_len)
+        self.chunk_in_progress.append(in_buf[start:start + count])
+        self._consume_in_buffer(count)
+        self.bytes_left -= count
         if self.bytes_left <= 0:
             # Finished with chunk
             self.bytes_left = None
+            chunk = ''.join(self.chunk_in_progress)
             if self.error:
-                self.error_in_progress.append(self.chunk_in_progress)
+                self.error_in_progress.append(chunk)
             else:
-                self.chunks.append(self.chunk_in_progress)
+                self.chunks.append(chunk)
             self.chunk_in_progress = None
             self.state_accept = self._state_accept_expecting_length
 
     def _state_accept_reading_unused(self):
         self.unused_data += self._get_in_buffer()
         self._in_buffer_list = []
+        self._in_buffer_len = 0
 
 
 class LengthPrefixedBodyDecoder(_StatefulDecoder):
@@ -534,7 +625,9 @@ class LengthPrefixedBodyDecoder(_StatefulDecoder):
         _StatefulDecoder.__init__(self)
         self.state_accept = self._state_accept_expecting_length
         self.state_read = self._state_read_no_data
-        self._body = ''
+        # Body chunks are kept in a list and only joined when read, so that a
+        # large body arriving in many pieces is not repeatedly copied.
+        self._body_chunks = []
         self._trailer_buffer = ''
 
     def next_read_size(self):
@@ -569,14 +662,15 @@ class LengthPrefixedBodyDecoder(_StatefulDecoder):
 
     def _state_accept_reading_body(self):
         in_buf = self._get_in_buffer()
-        self._body += in_buf
         self.bytes_left -= len(in_buf)
         self._set_in_buffer(None)
+        if self.bytes_left < 0:
+            # The excess can only be in the bytes we were just given.
+            self._trailer_buffer = in_buf[self.bytes_left:]
+            in_buf = in_buf[:self.bytes_left]
+        self._body_chunks.append(in_buf)
         if self.bytes_left <= 0:
             # Finished with body
-            if self.bytes_left != 0:
-                self._trailer_buffer = self._body[self.bytes_left:]
-                self._body = self._body[:self.bytes_left]
             self.bytes_left = None
             self.state_accept = self._state_accept_reading_trailer
 
@@ -598,8 +692,8 @@ class LengthPrefixedBodyDecoder(_StatefulDecoder):
         return ''
 
     def _state_read_body_buffer(self):
-        result = self._body
-        self._body = ''
+        result = ''.join(self._body_chunks)
+        self._body_chunks = []
         return result
 
 
@@ -901,6 +995,14 @@ class ProtocolThreeDecoder(_StatefulDecoder):
             self._number_needed_bytes = 4
         self.decoding_failed = False
         self.request_handler = self.message_handler = message_handler
+        # Map each message part kind byte to the state that reads that part.
+        # The end-of-message kind ('e') is handled separately by
+        # _state_accept_expecting_message_part.
+        self._message_part_states = {
+            'o': self._state_accept_expecting_one_byte,
+            's': self._state_accept_expecting_structure,
+            'b': self._state_accept_expecting_bytes,
+            }
 
     def accept_bytes(self, bytes):
         self._number_needed_bytes = None
@@ -1004,12 +1106,9 @@ class ProtocolThreeDecoder(_StatefulDecoder):
 
     def _state_accept_expecting_message_part(self):
         message_part_kind = self._extract_single_byte()
-        if message_part_kind == 'o':
-            self.state_accept = self._state_accept_expecting_one_byte
-        elif message_part_kind == 's':
-            self.state_accept = self._state_accept_expecting_structure
-        elif message_part_kind == 'b':
-            self.state_accept = self._state_accept_expecting_bytes
+        next_state = self._message_part_states.get(message_part_kind)
+        if next_state is not None:
+            self.state_accept = next_state
         elif message_part_kind == 'e':
             self.done()
         else:
@@ -1071,32 +1170,9 @@ class ProtocolThreeDecoder(_StatefulDecoder):
                 raise AssertionError("don't know how many bytes are expected!")
 
 
-class _ProtocolThreeEncoder(object):
+class _ProtocolThreeEncoder(_BufferedWriter):
 
     response_marker = request_marker = MESSAGE_VERSION_THREE
-    BUFFER_SIZE = 1024*1024 # 1 MiB buffer before flushing
-
-    def __init__(self, write_func):
-        self._buf = []
-        self._buf_len = 0
-        self._real_write_func = write_func
-
-    def _write_func(self, bytes):
-        # TODO: Another possibility would be to turn this into an async model.
-        #       Where we let another thread know that we have some bytes if
-        #       they want it, but we don't actually block for it
-        #       Note that osutils.send_all always sends 64kB chunks anyway, so
-        #       we might just push out smaller bits at a time?
-        self._buf.append(bytes)
-        self._buf_len += len(bytes)
-        if self._buf_len > self.BUFFER_SIZE:
-            self.flush()
-
-    def flush(self):
-        if self._buf:
-            self._real_write_func(''.join(self._buf))
-            del self._buf[:]
-            self._buf_len = 0
 
     def _serialise_offsets(self, offsets):
         """Serialise a readv offset list."""
@@ -216,6 +216,8 @@ class SmartServerResponse(object):
     SuccessfulSmartServerResponse and FailedSmartServerResponse as appropriate.
     """
 
+    __slots__ = ('args', 'body', 'body_stream')
+
     def __init__(self, args, body=None, body_stream=None):
         """Constructor.
 
@@ -246,6 +248,8 @@ class SmartServerResponse(object):
 class FailedSmartServerResponse(SmartServerResponse):
     """A SmartServerResponse for a request which failed."""
 
+    __slots__ = ()
+
     def is_successful(self):
         """FailedSmartServerResponse are not successful."""
         return False
@@ -254,6 +258,8 @@ class FailedSmartServerResponse(SmartServerResponse):
 class SuccessfulSmartServerResponse(SmartServerResponse):
     """A SmartServerResponse for a successfully completed request."""
 
+    __slots__ = ()
+
     def is_successful(self):
         """SuccessfulSmartServerResponse are successful."""
         return True
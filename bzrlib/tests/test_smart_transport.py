@@ -21,6 +21,7 @@ from cStringIO import StringIO
 import doctest
 import errno
 import os
+import select
 import socket
 import subprocess
 import sys
@@ -71,6 +72,9 @@ def create_file_pipes():
     return rf, wf
 
 
+_MSG_WAITALL = getattr(socket, 'MSG_WAITALL', None)
+
+
 def portable_socket_pair():
     """Return a pair of TCP sockets connected to each other.
 
@@ -83,9 +87,47 @@ def portable_socket_pair():
     client_sock.connect(listen_sock.getsockname())
     server_sock, addr = listen_sock.accept()
     listen_sock.close()
+    # Avoid Nagle/delayed-ack stalls on the small writes the tests make.
+    for sock in (server_sock, client_sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     return server_sock, client_sock
 
 
+def socket_pair():
+    """Return a pair of stream sockets connected to each other.
+
+    Where socket.socketpair is available (i.e. not on Windows) this avoids the
+    TCP handshake done by portable_socket_pair, but the sockets are then not
+    TCP sockets.  Use portable_socket_pair for code that sets TCP options.
+    """
+    if getattr(socket, 'socketpair', None) is None:
+        return portable_socket_pair()
+    return socket.socketpair()
+
+
+# The commands SmartSSHClientMedium is expected to pass to connect_ssh.
+_EXPECTED_BZR_SERVE_ARGV = [
+    'bzr', 'serve', '--inet', '--directory=/', '--allow-writes']
+_EXPECTED_FUGLY_SERVE_ARGV = [
+    'fugly', 'serve', '--inet', '--directory=/', '--allow-writes']
+
+
+class _FlushingBuf(object):
+    """A cStringIO wrapper that records calls to flush."""
+
+    __slots__ = ('_io', 'flush_calls')
+
+    def __init__(self):
+        self._io = StringIO()
+        self.flush_calls = []
+
+    def __getattr__(self, name):
+        return getattr(self._io, name)
+
+    def flush(self):
+        self.flush_calls.append('flush')
+
+
 class StringIOSSHVendor(object):
     """A SSH vendor that uses StringIO to buffer writes and answer reads."""
 
@@ -167,9 +209,15 @@ class _InvalidHostnameFeature(features.Feature):
     it's possible a badly misconfigured name server might decide to always
     return an address for any name, so this feature allows us to distinguish a
     broken system from a broken test.
+
+    Setting BZR_TEST_SKIP_DNS_PROBE in the environment reports the feature as
+    unavailable without doing any lookup, for hosts where resolving the name
+    is slow.
     """
 
     def _probe(self):
+        if os.environ.get('BZR_TEST_SKIP_DNS_PROBE'):
+            return False
         try:
             socket.gethostbyname('non_existent.invalid')
         except socket.gaierror:
@@ -184,37 +232,13 @@ class _InvalidHostnameFeature(features.Feature):
 InvalidHostnameFeature = _InvalidHostnameFeature()
 
 
-class SmartClientMediumTests(tests.TestCase):
-    """Tests for SmartClientMedium.
+# The media are never asked to connect in the tests that construct them
+# with this port, so any number will do; nothing normally listens on port 1.
+_UNOPENED_PORT = 1
 
-    We should create a test scenario for this: we need a server module that
-    construct the test-servers (like make_loopsocket_and_medium), and the list
-    of SmartClientMedium classes to test.
-    """
 
-    def make_loopsocket_and_medium(self):
-        """Create a loopback socket for testing, and a medium aimed at it."""
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind(('127.0.0.1', 0))
-        sock.listen(1)
-        port = sock.getsockname()[1]
-        client_medium = medium.SmartTCPClientMedium('127.0.0.1', port, 'base')
-        return sock, client_medium
-
-    def receive_bytes_on_server(self, sock, bytes):
-        """Accept a connection on sock and read 3 bytes.
-
-        The bytes are appended to the list bytes.
-
-        :return: a Thread which is running to do the accept and recv.
-        """
-        def _receive_bytes_on_server():
-            connection, address = sock.accept()
-            bytes.append(osutils.recv_all(connection, 3))
-            connection.close()
-        t = threading.Thread(target=_receive_bytes_on_server)
-        t.start()
-        return t
+class SmartSimplePipesClientMediumTests(tests.TestCase):
+    """Tests for SmartSimplePipesClientMedium."""
 
     def test_construct_smart_simple_pipes_client_medium(self):
         # the SimplePipes client medium takes two pipes:
@@ -385,12 +409,8 @@ class SmartClientMediumTests(tests.TestCase):
         # invoking _flush on a SimplePipesClient should flush the output
         # pipe. We test this by creating an output pipe that records
         # flush calls made to it.
-        from StringIO import StringIO # get regular StringIO
         input = StringIO()
-        output = StringIO()
-        flush_calls = []
-        def logging_flush(): flush_calls.append('flush')
-        output.flush = logging_flush
+        output = _FlushingBuf()
         client_medium = medium.SmartSimplePipesClientMedium(
             input, output, 'base')
         # this call is here to ensure we only flush once, not on every
@@ -398,54 +418,48 @@ class SmartClientMediumTests(tests.TestCase):
         client_medium._accept_bytes('abc')
         client_medium._flush()
         client_medium.disconnect()
-        self.assertEqual(['flush'], flush_calls)
+        self.assertEqual(['flush'], output.flush_calls)
+
+
+class SmartSSHClientMediumTests(tests.TestCase):
+    """Tests for SmartSSHClientMedium."""
 
     def test_construct_smart_ssh_client_medium(self):
         # the SSH client medium takes:
         # host, port, username, password, vendor
         # Constructing one should just save these and do nothing.
-        # we test this by creating a empty bound socket and constructing
-        # a medium.
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind(('127.0.0.1', 0))
-        unopened_port = sock.getsockname()[1]
+        # we test this by constructing a medium aimed at an unopened port.
         # having vendor be invalid means that if it tries to connect via the
         # vendor it will blow up.
-        ssh_params = medium.SSHParams('127.0.0.1', unopened_port, None, None)
+        ssh_params = medium.SSHParams('127.0.0.1', _UNOPENED_PORT, None, None)
         client_medium = medium.SmartSSHClientMedium(
             'base', ssh_params, "not a vendor")
-        sock.close()
 
-    def test_ssh_client_connects_on_first_use(self):
-        # The only thing that initiates a connection from the medium is giving
-        # it bytes.
+    def assertConnectsWithCommand(self, expected_command, ssh_params):
+        """Check the command a SmartSSHClientMedium asks its vendor to run.
+
+        The only thing that initiates a connection from the medium is giving
+        it bytes, so this sends some and checks they arrive.
+        """
         output = StringIO()
         vendor = StringIOSSHVendor(StringIO(), output)
-        ssh_params = medium.SSHParams(
-            'a hostname', 'a port', 'a username', 'a password', 'bzr')
         client_medium = medium.SmartSSHClientMedium('base', ssh_params, vendor)
         client_medium._accept_bytes('abc')
         self.assertEqual('abc', output.getvalue())
         self.assertEqual([('connect_ssh', 'a username', 'a password',
-            'a hostname', 'a port',
-            ['bzr', 'serve', '--inet', '--directory=/', '--allow-writes'])],
+            'a hostname', 'a port', expected_command)],
             vendor.calls)
 
+    def test_ssh_client_connects_on_first_use(self):
+        self.assertConnectsWithCommand(_EXPECTED_BZR_SERVE_ARGV,
+            medium.SSHParams(
+                'a hostname', 'a port', 'a username', 'a password', 'bzr'))
+
     def test_ssh_client_changes_command_when_bzr_remote_path_passed(self):
-        # The only thing that initiates a connection from the medium is giving
-        # it bytes.
-        output = StringIO()
-        vendor = StringIOSSHVendor(StringIO(), output)
-        ssh_params = medium.SSHParams(
-            'a hostname', 'a port', 'a username', 'a password',
-            bzr_remote_path='fugly')
-        client_medium = medium.SmartSSHClientMedium('base', ssh_params, vendor)
-        client_medium._accept_bytes('abc')
-        self.assertEqual('abc', output.getvalue())
-        self.assertEqual([('connect_ssh', 'a username', 'a password',
-            'a hostname', 'a port',
-            ['fugly', 'serve', '--inet', '--directory=/', '--allow-writes'])],
-            vendor.calls)
+        self.assertConnectsWithCommand(_EXPECTED_FUGLY_SERVE_ARGV,
+            medium.SSHParams(
+                'a hostname', 'a port', 'a username', 'a password',
+                bzr_remote_path='fugly'))
 
     def test_ssh_client_disconnect_does_so(self):
         # calling disconnect should disconnect both the read_from and write_to
@@ -461,7 +475,7 @@ class SmartClientMediumTests(tests.TestCase):
         self.assertTrue(output.closed)
         self.assertEqual([
             ('connect_ssh', None, None, 'a hostname', None,
-            ['bzr', 'serve', '--inet', '--directory=/', '--allow-writes']),
+            _EXPECTED_BZR_SERVE_ARGV),
             ('close', ),
             ],
             vendor.calls)
@@ -492,10 +506,10 @@ class SmartClientMediumTests(tests.TestCase):
         self.assertTrue(output2.closed)
         self.assertEqual([
             ('connect_ssh', None, None, 'a hostname', None,
-            ['bzr', 'serve', '--inet', '--directory=/', '--allow-writes']),
+            _EXPECTED_BZR_SERVE_ARGV),
             ('close', ),
             ('connect_ssh', None, None, 'a hostname', None,
-            ['bzr', 'serve', '--inet', '--directory=/', '--allow-writes']),
+            _EXPECTED_BZR_SERVE_ARGV),
             ('close', ),
             ],
             vendor.calls)
@@ -542,12 +556,8 @@ class SmartClientMediumTests(tests.TestCase):
         # invoking _flush on a SSHClientMedium should flush the output
         # pipe. We test this by creating an output pipe that records
         # flush calls made to it.
-        from StringIO import StringIO # get regular StringIO
         input = StringIO()
-        output = StringIO()
-        flush_calls = []
-        def logging_flush(): flush_calls.append('flush')
-        output.flush = logging_flush
+        output = _FlushingBuf()
         vendor = StringIOSSHVendor(input, output)
         client_medium = medium.SmartSSHClientMedium(
             'base', medium.SSHParams('a hostname'), vendor=vendor)
@@ -556,41 +566,80 @@ class SmartClientMediumTests(tests.TestCase):
         client_medium._accept_bytes('abc')
         client_medium._flush()
         client_medium.disconnect()
-        self.assertEqual(['flush'], flush_calls)
+        self.assertEqual(['flush'], output.flush_calls)
+
+
+class SmartClientMediumTests(tests.TestCase):
+    """Tests for SmartClientMedium over TCP.
+
+    The SimplePipes and SSH media are tested by
+    SmartSimplePipesClientMediumTests and SmartSSHClientMediumTests.
+
+    We should create a test scenario for this: we need a server module that
+    construct the test-servers (like make_loopsocket_and_medium), and the list
+    of SmartClientMedium classes to test.
+    """
+
+    def make_loopsocket_and_medium(self):
+        """Create a loopback socket for testing, and a medium aimed at it."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        port = sock.getsockname()[1]
+        client_medium = medium.SmartTCPClientMedium('127.0.0.1', port, 'base')
+        return sock, client_medium
+
+    def receive_bytes_on_server(self, sock, timeout=10.0):
+        """Accept a connection on sock and read 3 bytes.
+
+        The client must already have connected and sent its bytes; the kernel
+        queues both until they are accepted and read, so this doesn't need to
+        run in a separate thread.
+
+        :return: the bytes read, which will be fewer than 3 if the client
+            disconnected first.
+        """
+        readable, _, _ = select.select([sock], [], [], timeout)
+        if not readable:
+            self.fail('No connection to accept after %.1f seconds' % timeout)
+        connection, address = sock.accept()
+        # SmartTCPClientMedium already sets TCP_NODELAY on its end.
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            if _MSG_WAITALL is None:
+                # Windows lacks MSG_WAITALL, so loop on short reads instead.
+                return osutils.recv_all(connection, 3)
+            buf = bytearray(3)
+            count = connection.recv_into(buf, 3, _MSG_WAITALL)
+            return str(buf[:count])
+        finally:
+            connection.close()
 
     def test_construct_smart_tcp_client_medium(self):
         # the TCP client medium takes a host and a port.  Constructing it won't
         # connect to anything.
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind(('127.0.0.1', 0))
-        unopened_port = sock.getsockname()[1]
         client_medium = medium.SmartTCPClientMedium(
-            '127.0.0.1', unopened_port, 'base')
-        sock.close()
+            '127.0.0.1', _UNOPENED_PORT, 'base')
 
     def test_tcp_client_connects_on_first_use(self):
         # The only thing that initiates a connection from the medium is giving
         # it bytes.
         sock, medium = self.make_loopsocket_and_medium()
-        bytes = []
-        t = self.receive_bytes_on_server(sock, bytes)
         medium.accept_bytes('abc')
-        t.join()
+        bytes = self.receive_bytes_on_server(sock)
         sock.close()
-        self.assertEqual(['abc'], bytes)
+        self.assertEqual('abc', bytes)
 
     def test_tcp_client_disconnect_does_so(self):
         # calling disconnect on the client terminates the connection.
         # we test this by forcing a short read during a socket.MSG_WAITALL
         # call: write 2 bytes, try to read 3, and then the client disconnects.
         sock, medium = self.make_loopsocket_and_medium()
-        bytes = []
-        t = self.receive_bytes_on_server(sock, bytes)
         medium.accept_bytes('ab')
         medium.disconnect()
-        t.join()
+        bytes = self.receive_bytes_on_server(sock)
         sock.close()
-        self.assertEqual(['ab'], bytes)
+        self.assertEqual('ab', bytes)
         # now disconnect again: this should not do anything, if disconnection
         # really did disconnect.
         medium.disconnect()
@@ -613,17 +662,15 @@ class SmartClientMediumTests(tests.TestCase):
         # invoking _flush on a TCPClientMedium should do something useful.
         # RBC 20060922 not sure how to test/tell in this case.
         sock, medium = self.make_loopsocket_and_medium()
-        bytes = []
-        t = self.receive_bytes_on_server(sock, bytes)
         # try with nothing buffered
         medium._flush()
         medium._accept_bytes('ab')
         # and with something sent.
         medium._flush()
         medium.disconnect()
-        t.join()
+        bytes = self.receive_bytes_on_server(sock)
         sock.close()
-        self.assertEqual(['ab'], bytes)
+        self.assertEqual('ab', bytes)
         # now disconnect again : this should not do anything, if disconnection
         # really did disconnect.
         medium.disconnect()
@@ -748,7 +795,7 @@ class TestSmartClientStreamMediumRequest(tests.TestCase):
         self.assertRaises(errors.ReadingCompleted, request.read_bytes, None)
 
     def test_reset(self):
-        server_sock, client_sock = portable_socket_pair()
+        server_sock, client_sock = socket_pair()
         # TODO: Use SmartClientAlreadyConnectedSocketMedium for the versions of
         #       bzr where it exists.
         client_medium = medium.SmartTCPClientMedium(None, None, None)
@@ -795,25 +842,47 @@ class ErrorRaisingProtocol(object):
         raise self.exception
 
 
+# Canned inputs for TestSmartServerStreamMedium, built once.
+_BULK_DATA_REQUEST_BYTES = 'command\n9\nbulk datadone\n'
+_UTF8_FILENAME = u'testfile\N{INTERROBANG}'.encode('utf-8')
+
+
 class SampleRequest(object):
 
     def __init__(self, expected_bytes):
-        self.accepted_bytes = ''
+        # Accepted bytes are kept as a list of chunks, and only joined when
+        # needed, so that being fed one byte at a time isn't quadratic.
+        self._chunks = []
+        self._len = 0
         self._finished_reading = False
         self.expected_bytes = expected_bytes
         self.unused_data = ''
 
+    @property
+    def accepted_bytes(self):
+        if len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks)]
+        if self._chunks:
+            return self._chunks[0]
+        return ''
+
     def accept_bytes(self, bytes):
-        self.accepted_bytes += bytes
-        if self.accepted_bytes.startswith(self.expected_bytes):
+        self._chunks.append(bytes)
+        self._len += len(bytes)
+        if self._len < len(self.expected_bytes):
+            return
+        accepted_bytes = self.accepted_bytes
+        if accepted_bytes.startswith(self.expected_bytes):
             self._finished_reading = True
-            self.unused_data = self.accepted_bytes[len(self.expected_bytes):]
+            self.unused_data = accepted_bytes[len(self.expected_bytes):]
 
     def next_read_size(self):
         if self._finished_reading:
             return 0
         else:
-            return 1
+            # Ask for everything we still expect, so the medium can read it
+            # in one go rather than a byte at a time.
+            return max(1, len(self.expected_bytes) - self._len)
 
 
 class TestSmartServerStreamMedium(tests.TestCase):
@@ -848,60 +917,90 @@ class TestSmartServerStreamMedium(tests.TestCase):
     def create_socket_context(self, transport, timeout=4.0):
         """Create a new SmartServerSocketStreamMedium with default context.
 
-        This will call portable_socket_pair and pass the server side to
+        This will call socket_pair and pass the server side to
         create_socket_medium along with transport.
         It then returns the client_sock and the server.
         """
-        server_sock, client_sock = portable_socket_pair()
+        server_sock, client_sock = socket_pair()
         server = self.create_socket_medium(server_sock, transport,
                                            timeout=timeout)
         return server, client_sock
 
+    def assertPeerClosed(self, sock, timeout=10.0):
+        """Assert that the other end of sock has been closed.
+
+        This waits for sock to become readable before calling recv, so a
+        server that fails to close the connection fails the test rather than
+        hanging it.
+        """
+        readable, _, _ = select.select([sock], [], [], timeout)
+        if not readable:
+            self.fail('%r was not closed after %.1f seconds'
+                      % (sock, timeout))
+        self.assertEqual('', sock.recv(1))
+
     def test_smart_query_version(self):
         """Feed a canned query version to a server"""
         # wire-to-wire, using the whole stack
         transport = local.LocalTransport(urlutils.local_path_to_url('/'))
-        server, from_server = self.create_pipe_context('hello\n', transport)
+        server, _ = self.create_pipe_context('hello\n', transport)
+        response = bytearray()
         smart_protocol = protocol.SmartServerRequestProtocolOne(transport,
-                from_server.write)
+                response.extend)
         server._serve_one_request(smart_protocol)
         self.assertEqual('ok\0012\n',
-                         from_server.getvalue())
+                         str(response))
 
     def test_response_to_canned_get(self):
         transport = memory.MemoryTransport('memory:///')
         transport.put_bytes('testfile', 'contents\nof\nfile\n')
-        server, from_server = self.create_pipe_context('get\001./testfile\n',
+        server, _ = self.create_pipe_context('get\001./testfile\n',
             transport)
+        response = bytearray()
         smart_protocol = protocol.SmartServerRequestProtocolOne(transport,
-                from_server.write)
+                response.extend)
         server._serve_one_request(smart_protocol)
         self.assertEqual('ok\n'
                          '17\n'
                          'contents\nof\nfile\n'
                          'done\n',
-                         from_server.getvalue())
+                         str(response))
 
     def test_response_to_canned_get_of_utf8(self):
         # wire-to-wire, using the whole stack, with a UTF-8 filename.
         transport = memory.MemoryTransport('memory:///')
-        utf8_filename = u'testfile\N{INTERROBANG}'.encode('utf-8')
+        utf8_filename = _UTF8_FILENAME
         # VFS requests use filenames, not raw UTF-8.
         hpss_path = urlutils.escape(utf8_filename)
         transport.put_bytes(utf8_filename, 'contents\nof\nfile\n')
-        server, from_server = self.create_pipe_context(
+        server, _ = self.create_pipe_context(
                 'get\001' + hpss_path + '\n', transport)
+        response = bytearray()
         smart_protocol = protocol.SmartServerRequestProtocolOne(transport,
-                from_server.write)
+                response.extend)
         server._serve_one_request(smart_protocol)
         self.assertEqual('ok\n'
                          '17\n'
                          'contents\nof\nfile\n'
                          'done\n',
-                         from_server.getvalue())
+                         str(response))
+
+    def test_pipe_get_line_does_not_read_past_newline(self):
+        to_server = StringIO('first line\nsecond line\n')
+        server = self.create_pipe_medium(to_server, StringIO(), None)
+        self.assertEqual('first line\n', server._get_line())
+        self.assertEqual('second line\n', to_server.read())
+
+    def test_pipe_get_line_uses_push_back_buffer(self):
+        to_server = StringIO('ond line\nthird line\n')
+        server = self.create_pipe_medium(to_server, StringIO(), None)
+        server._push_back('first line\nsec')
+        self.assertEqual('first line\n', server._get_line())
+        self.assertEqual('second line\n', server._get_line())
+        self.assertEqual('third line\n', to_server.read())
 
     def test_pipe_like_stream_with_bulk_data(self):
-        sample_request_bytes = 'command\n9\nbulk datadone\n'
+        sample_request_bytes = _BULK_DATA_REQUEST_BYTES
         server, from_server = self.create_pipe_context(
             sample_request_bytes, None)
         sample_protocol = SampleRequest(expected_bytes=sample_request_bytes)
@@ -911,16 +1010,43 @@ class TestSmartServerStreamMedium(tests.TestCase):
         self.assertFalse(server.finished)
 
     def test_socket_stream_with_bulk_data(self):
-        sample_request_bytes = 'command\n9\nbulk datadone\n'
+        sample_request_bytes = _BULK_DATA_REQUEST_BYTES
         server, client_sock = self.create_socket_context(None)
         sample_protocol = SampleRequest(expected_bytes=sample_request_bytes)
         client_sock.sendall(sample_request_bytes)
         server._serve_one_request(sample_protocol)
         server._disconnect_client()
-        self.assertEqual('', client_sock.recv(1))
+        self.assertPeerClosed(client_sock)
         self.assertEqual(sample_request_bytes, sample_protocol.accepted_bytes)
         self.assertFalse(server.finished)
 
+    def test_socket_stream_read_size_grows(self):
+        server, client_sock = self.create_socket_context(None)
+        self.overrideAttr(medium, '_MAX_READ_SIZE', 16384)
+        client_sock.sendall('x' * 50000)
+        # recv may return less than was asked for (e.g. on the TCP pair used
+        # where socketpair is unavailable), so check how _read_size changes
+        # rather than the exact number of bytes each read returns.
+        read_sizes = [server._read_size]
+        for i in range(4):
+            bytes = server.read_bytes(osutils.MAX_SOCKET_CHUNK)
+            self.assertTrue(0 < len(bytes) <= read_sizes[-1])
+            read_sizes.append(server._read_size)
+        self.assertEqual(sorted(read_sizes), read_sizes)
+        self.assertTrue(read_sizes[-1] > read_sizes[0])
+        self.assertTrue(read_sizes[-1] <= 16384)
+
+    def test_socket_stream_write_out_sends_immediately(self):
+        # Protocols flush streamed response bodies chunk by chunk, so the
+        # socket medium must send each write straight away rather than hold
+        # it until the request has been served.
+        server, client_sock = self.create_socket_context(None)
+        client_sock.settimeout(10.0)
+        server._write_out('first chunk')
+        self.assertEqual('first chunk', client_sock.recv(4096))
+        server._write_out('second chunk')
+        self.assertEqual('second chunk', client_sock.recv(4096))
+
     def test_pipe_like_stream_shutdown_detection(self):
         server, _ = self.create_pipe_context('', None)
         server._serve_one_request(SampleRequest('x'))
@@ -953,7 +1079,7 @@ class TestSmartServerStreamMedium(tests.TestCase):
         server._disconnect_client()
         self.assertEqual(expected_response, osutils.recv_all(client_sock, 50),
                          "Not a version 2 response to 'hello' request.")
-        self.assertEqual('', client_sock.recv(1))
+        self.assertPeerClosed(client_sock)
 
     def test_pipe_stream_incomplete_request(self):
         """The medium should still construct the right protocol version even if
@@ -1030,7 +1156,7 @@ class TestSmartServerStreamMedium(tests.TestCase):
         self.assertEqual(sample_request_bytes, second_protocol.accepted_bytes)
         self.assertFalse(server.finished)
         server._disconnect_client()
-        self.assertEqual('', client_sock.recv(1))
+        self.assertPeerClosed(client_sock)
 
     def test_pipe_like_stream_error_handling(self):
         # Use plain python StringIO so we can monkey-patch the close method to
@@ -1056,7 +1182,7 @@ class TestSmartServerStreamMedium(tests.TestCase):
         server._serve_one_request(fake_protocol)
         # recv should not block, because the other end of the socket has been
         # closed.
-        self.assertEqual('', client_sock.recv(1))
+        self.assertPeerClosed(client_sock)
         self.assertTrue(server.finished)
 
     def test_pipe_like_stream_keyboard_interrupt_handling(self):
@@ -1072,7 +1198,7 @@ class TestSmartServerStreamMedium(tests.TestCase):
         self.assertRaises(
             KeyboardInterrupt, server._serve_one_request, fake_protocol)
         server._disconnect_client()
-        self.assertEqual('', client_sock.recv(1))
+        self.assertPeerClosed(client_sock)
 
     def build_protocol_pipe_like(self, bytes):
         server, _ = self.create_pipe_context(bytes, None)
@@ -1081,7 +1207,11 @@ class TestSmartServerStreamMedium(tests.TestCase):
     def build_protocol_socket(self, bytes):
         server, client_sock = self.create_socket_context(None)
         client_sock.sendall(bytes)
-        client_sock.close()
+        # Only shut down our sending side: a version one protocol answers a
+        # bad request straight away, and writing to a closed peer fails at
+        # once on a socketpair (where TCP would accept the first write).
+        client_sock.shutdown(socket.SHUT_WR)
+        self.addCleanup(client_sock.close)
         return server._build_protocol()
 
     def assertProtocolOne(self, server_protocol):
@@ -1158,6 +1288,15 @@ class TestSmartServerStreamMedium(tests.TestCase):
         data = server.read_bytes(1)
         self.assertEqual('', data)
 
+    def test_socket_build_protocol_from_push_back_does_not_wait(self):
+        # The client has already sent the whole request, which is sitting in
+        # the push back buffer, so there is nothing to wait for.
+        server, client_sock = self.create_socket_context(None, timeout=0.01)
+        server._push_back('hello\n')
+        server_protocol = server._build_protocol()
+        self.assertIsInstance(server_protocol,
+                              protocol.SmartServerRequestProtocolOne)
+
     def test_socket_wait_for_bytes_with_timeout_closed(self):
         server, client_sock = self.create_socket_context(None)
         # With the socket closed, this should return right away.
@@ -1186,7 +1325,7 @@ class TestSmartServerStreamMedium(tests.TestCase):
         # This should timeout quickly, and then close the connection so that
         # client_sock recv doesn't block.
         server.serve()
-        self.assertEqual('', client_sock.recv(1))
+        self.assertPeerClosed(client_sock)
 
     def test_pipe_wait_for_bytes_with_timeout_with_data(self):
         # We intentionally use a real pipe here, so that we can 'select' on it.
@@ -1260,6 +1399,27 @@ class TestGetProtocolFactoryForBytes(tests.TestCase):
         self.assertEqual('anything\n', remainder)
 
 
+class TestGetLine(tests.TestCase):
+    """Tests for medium._get_line."""
+
+    def get_line(self, chunks):
+        chunks = list(chunks)
+        def read_bytes(count):
+            if not chunks:
+                return ''
+            return chunks.pop(0)
+        return medium._get_line(read_bytes)
+
+    def test_line_in_one_read(self):
+        self.assertEqual(('abc\n', 'def'), self.get_line(['abc\ndef']))
+
+    def test_line_across_reads(self):
+        self.assertEqual(('abc\n', 'de'), self.get_line(['a', 'b', 'c\nde']))
+
+    def test_eof_before_newline(self):
+        self.assertEqual(('abc', ''), self.get_line(['ab', 'c']))
+
+
 class TestSmartTCPServer(tests.TestCase):
 
     def make_server(self):
@@ -1356,7 +1516,7 @@ class TestSmartTCPServer(tests.TestCase):
 
     def test_propagates_timeout(self):
         server = _mod_server.SmartTCPServer(None, client_timeout=1.23)
-        server_sock, client_sock = portable_socket_pair()
+        server_sock, client_sock = socket_pair()
         handler = server._make_handler(server_sock)
         self.assertEqual(1.23, handler._client_timeout)
 
@@ -2117,6 +2277,19 @@ class TestVersionOneFeaturesInProtocolOne(
         self.assertEqual('', smart_protocol.unused_data)
         self.assertEqual('', smart_protocol.in_buffer)
 
+    def test_accept_request_one_byte_at_a_time(self):
+        self.overrideEnv('BZR_NO_SMART_VFS', None)
+        mem_transport = memory.MemoryTransport()
+        mem_transport.put_bytes('foo', 'abcdefghij')
+        out_stream = StringIO()
+        smart_protocol = protocol.SmartServerRequestProtocolOne(mem_transport,
+                out_stream.write)
+        for byte in 'readv\x01foo\n3\n3,3done\nX':
+            smart_protocol.accept_bytes(byte)
+        self.assertEqual('readv\n3\ndefdone\n', out_stream.getvalue())
+        self.assertEqual('X', smart_protocol.unused_data)
+        self.assertEqual('', smart_protocol.in_buffer)
+
     def test_accept_excess_bytes_are_preserved(self):
         out_stream = StringIO()
         smart_protocol = protocol.SmartServerRequestProtocolOne(
@@ -2163,6 +2336,14 @@ class TestVersionOneFeaturesInProtocolOne(
         self.assertRaises(AttributeError, smart_protocol._send_response,
             _mod_request.SmartServerResponse(('x',)))
 
+    def test__send_response_writes_once(self):
+        writes = []
+        smart_protocol = protocol.SmartServerRequestProtocolOne(
+            None, writes.append)
+        smart_protocol._send_response(
+            _mod_request.SuccessfulSmartServerResponse(('x',), 'body'))
+        self.assertEqual(['x\n4\nbodydone\n'], writes)
+
     def test_query_version(self):
         """query_version on a SmartClientProtocolOne should return a number.
 
@@ -2173,12 +2354,7 @@ class TestVersionOneFeaturesInProtocolOne(
         # accept_bytes(tuple_based_encoding_of_hello) and reads and parses the
         # response of tuple-encoded (ok, 1).  Also, separately we should test
         # the error if the response is a non-understood version.
-        input = StringIO('ok\x012\n')
-        output = StringIO()
-        client_medium = medium.SmartSimplePipesClientMedium(
-            input, output, 'base')
-        request = client_medium.get_request()
-        smart_protocol = protocol.SmartClientRequestProtocolOne(request)
+        smart_protocol, _ = self.make_client_protocol('ok\x012\n')
         self.assertEqual(2, smart_protocol.query_version())
 
     def test_client_call_empty_response(self):
@@ -2197,12 +2373,8 @@ class TestVersionOneFeaturesInProtocolOne(
         # protocol.call_with_body_bytes should length-prefix the bytes onto the
         # wire.
         expected_bytes = "foo\n7\nabcdefgdone\n"
-        input = StringIO("\n")
-        output = StringIO()
-        client_medium = medium.SmartSimplePipesClientMedium(
-            input, output, 'base')
-        request = client_medium.get_request()
-        smart_protocol = protocol.SmartClientRequestProtocolOne(request)
+        smart_protocol, _, output = self.make_client_protocol_and_output(
+            "\n")
         smart_protocol.call_with_body_bytes(('foo', ), "abcdefg")
         self.assertEqual(expected_bytes, output.getvalue())
 
@@ -2210,12 +2382,8 @@ class TestVersionOneFeaturesInProtocolOne(
         # protocol.call_with_upload should encode the readv array and then
         # length-prefix the bytes onto the wire.
         expected_bytes = "foo\n7\n1,2\n5,6done\n"
-        input = StringIO("\n")
-        output = StringIO()
-        client_medium = medium.SmartSimplePipesClientMedium(
-            input, output, 'base')
-        request = client_medium.get_request()
-        smart_protocol = protocol.SmartClientRequestProtocolOne(request)
+        smart_protocol, _, output = self.make_client_protocol_and_output(
+            "\n")
         smart_protocol.call_with_body_readv_array(('foo', ), [(1,2),(5,6)])
         self.assertEqual(expected_bytes, output.getvalue())
 
@@ -2260,12 +2428,7 @@ class TestVersionOneFeaturesInProtocolOne(
         # a response.
         expected_bytes = "1234567"
         server_bytes = "ok\n7\n1234567done\n"
-        input = StringIO(server_bytes)
-        output = StringIO()
-        client_medium = medium.SmartSimplePipesClientMedium(
-            input, output, 'base')
-        request = client_medium.get_request()
-        smart_protocol = protocol.SmartClientRequestProtocolOne(request)
+        smart_protocol, _ = self.make_client_protocol(server_bytes)
         smart_protocol.call('foo')
         smart_protocol.read_response_tuple(True)
         self.assertEqual(expected_bytes, smart_protocol.read_body_bytes())
@@ -2278,12 +2441,7 @@ class TestVersionOneFeaturesInProtocolOne(
         # that.
         expected_bytes = "1234567"
         server_bytes = "ok\n7\n1234567done\n"
-        input = StringIO(server_bytes)
-        output = StringIO()
-        client_medium = medium.SmartSimplePipesClientMedium(
-            input, output, 'base')
-        request = client_medium.get_request()
-        smart_protocol = protocol.SmartClientRequestProtocolOne(request)
+        smart_protocol, _ = self.make_client_protocol(server_bytes)
         smart_protocol.call('foo')
         smart_protocol.read_response_tuple(True)
         self.assertEqual(expected_bytes[0:2], smart_protocol.read_body_bytes(2))
@@ -2311,12 +2469,7 @@ class TestVersionOneFeaturesInProtocolOne(
 
     def test_client_read_body_bytes_interrupted_connection(self):
         server_bytes = "ok\n999\nincomplete body"
-        input = StringIO(server_bytes)
-        output = StringIO()
-        client_medium = medium.SmartSimplePipesClientMedium(
-            input, output, 'base')
-        request = client_medium.get_request()
-        smart_protocol = self.client_protocol_class(request)
+        smart_protocol, _ = self.make_client_protocol(server_bytes)
         smart_protocol.call('foo')
         smart_protocol.read_response_tuple(True)
         self.assertRaises(
@@ -2499,12 +2652,7 @@ class TestVersionOneFeaturesInProtocolTwo(
         expected_bytes = "1234567"
         server_bytes = (self.response_marker +
                         "success\nok\n7\n1234567done\n")
-        input = StringIO(server_bytes)
-        output = StringIO()
-        client_medium = medium.SmartSimplePipesClientMedium(
-            input, output, 'base')
-        request = client_medium.get_request()
-        smart_protocol = self.client_protocol_class(request)
+        smart_protocol, _ = self.make_client_protocol(server_bytes)
         smart_protocol.call('foo')
         smart_protocol.read_response_tuple(True)
         self.assertEqual(expected_bytes, smart_protocol.read_body_bytes())
@@ -2517,12 +2665,7 @@ class TestVersionOneFeaturesInProtocolTwo(
         # that.
         expected_bytes = "1234567"
         server_bytes = self.response_marker + "success\nok\n7\n1234567done\n"
-        input = StringIO(server_bytes)
-        output = StringIO()
-        client_medium = medium.SmartSimplePipesClientMedium(
-            input, output, 'base')
-        request = client_medium.get_request()
-        smart_protocol = self.client_protocol_class(request)
+        smart_protocol, _ = self.make_client_protocol(server_bytes)
         smart_protocol.call('foo')
         smart_protocol.read_response_tuple(True)
         self.assertEqual(expected_bytes[0:2], smart_protocol.read_body_bytes(2))
@@ -2551,12 +2694,7 @@ class TestVersionOneFeaturesInProtocolTwo(
     def test_client_read_body_bytes_interrupted_connection(self):
         server_bytes = (self.response_marker +
                         "success\nok\n999\nincomplete body")
-        input = StringIO(server_bytes)
-        output = StringIO()
-        client_medium = medium.SmartSimplePipesClientMedium(
-            input, output, 'base')
-        request = client_medium.get_request()
-        smart_protocol = self.client_protocol_class(request)
+        smart_protocol, _ = self.make_client_protocol(server_bytes)
         smart_protocol.call('foo')
         smart_protocol.read_response_tuple(True)
         self.assertRaises(
@@ -2645,6 +2783,26 @@ class TestSmartProtocolTwoSpecificsMixin(object):
             _mod_request.SuccessfulSmartServerResponse(('x',), body_stream=[]))
         self.assertEqual(0, smart_protocol.next_read_size())
 
+    def test__send_response_writes_each_body_stream_chunk(self):
+        # The response header and each chunk of a body stream are written as
+        # soon as they are available, not held back until the stream ends.
+        writes = []
+        writes_before_chunk = []
+        def body_stream():
+            for chunk in ['aaa', 'bb', 'c']:
+                writes_before_chunk.append(len(writes))
+                yield chunk
+        smart_protocol = protocol.SmartServerRequestProtocolTwo(
+            None, writes.append)
+        smart_protocol._send_response(
+            _mod_request.SuccessfulSmartServerResponse(
+                ('x',), body_stream=body_stream()))
+        self.assertEqual([2, 3, 4], writes_before_chunk)
+        self.assertEqual(
+            [protocol.RESPONSE_VERSION_TWO + 'success\nx\n', 'chunked\n',
+             '3\naaa', '2\nbb', '1\nc', 'END\n'],
+            writes)
+
     def test_streamed_body_bytes(self):
         body_header = 'chunked\n'
         two_body_chunks = "4\n1234" + "3\n567"
@@ -2652,12 +2810,7 @@ class TestSmartProtocolTwoSpecificsMixin(object):
         server_bytes = (protocol.RESPONSE_VERSION_TWO +
                         "success\nok\n" + body_header + two_body_chunks +
                         body_terminator)
-        input = StringIO(server_bytes)
-        output = StringIO()
-        client_medium = medium.SmartSimplePipesClientMedium(
-            input, output, 'base')
-        request = client_medium.get_request()
-        smart_protocol = protocol.SmartClientRequestProtocolTwo(request)
+        smart_protocol, _ = self.make_client_protocol(server_bytes)
         smart_protocol.call('foo')
         smart_protocol.read_response_tuple(True)
         stream = smart_protocol.read_streamed_body()
@@ -2673,12 +2826,7 @@ class TestSmartProtocolTwoSpecificsMixin(object):
         body = body_header + a_body_chunk + err_signal + err_chunks + finish
         server_bytes = (protocol.RESPONSE_VERSION_TWO +
                         "success\nok\n" + body)
-        input = StringIO(server_bytes)
-        output = StringIO()
-        client_medium = medium.SmartSimplePipesClientMedium(
-            input, output, 'base')
-        smart_request = client_medium.get_request()
-        smart_protocol = protocol.SmartClientRequestProtocolTwo(smart_request)
+        smart_protocol, _ = self.make_client_protocol(server_bytes)
         smart_protocol.call('foo')
         smart_protocol.read_response_tuple(True)
         expected_chunks = [
@@ -2692,12 +2840,7 @@ class TestSmartProtocolTwoSpecificsMixin(object):
         incomplete_body_chunk = "9999\nincomplete chunk"
         server_bytes = (protocol.RESPONSE_VERSION_TWO +
                         "success\nok\n" + body_header + incomplete_body_chunk)
-        input = StringIO(server_bytes)
-        output = StringIO()
-        client_medium = medium.SmartSimplePipesClientMedium(
-            input, output, 'base')
-        request = client_medium.get_request()
-        smart_protocol = protocol.SmartClientRequestProtocolTwo(request)
+        smart_protocol, _ = self.make_client_protocol(server_bytes)
         smart_protocol.call('foo')
         smart_protocol.read_response_tuple(True)
         stream = smart_protocol.read_streamed_body()
@@ -2705,12 +2848,7 @@ class TestSmartProtocolTwoSpecificsMixin(object):
 
     def test_client_read_response_tuple_sets_response_status(self):
         server_bytes = protocol.RESPONSE_VERSION_TWO + "success\nok\n"
-        input = StringIO(server_bytes)
-        output = StringIO()
-        client_medium = medium.SmartSimplePipesClientMedium(
-            input, output, 'base')
-        request = client_medium.get_request()
-        smart_protocol = protocol.SmartClientRequestProtocolTwo(request)
+        smart_protocol, _ = self.make_client_protocol(server_bytes)
         smart_protocol.call('foo')
         smart_protocol.read_response_tuple(False)
         self.assertEqual(True, smart_protocol.response_status)
@@ -2723,12 +2861,7 @@ class TestSmartProtocolTwoSpecificsMixin(object):
             protocol.RESPONSE_VERSION_TWO +
             "failed\n" +
             "error\x01Generic bzr smart protocol error: bad request 'foo'\n")
-        input = StringIO(server_bytes)
-        output = StringIO()
-        client_medium = medium.SmartSimplePipesClientMedium(
-            input, output, 'base')
-        request = client_medium.get_request()
-        smart_protocol = protocol.SmartClientRequestProtocolTwo(request)
+        smart_protocol, _ = self.make_client_protocol(server_bytes)
         smart_protocol.call('foo')
         self.assertRaises(
             errors.UnknownSmartMethod, smart_protocol.read_response_tuple)
@@ -3839,10 +3972,10 @@ class Test_SmartClientRequest(tests.TestCase):
                          output.getvalue())
         self.assertEqual(
             [('connect_ssh', 'a user', 'a pass', 'a host', 'a port',
-              ['bzr', 'serve', '--inet', '--directory=/', '--allow-writes']),
+              _EXPECTED_BZR_SERVE_ARGV),
              ('close',),
              ('connect_ssh', 'a user', 'a pass', 'a host', 'a port',
-              ['bzr', 'serve', '--inet', '--directory=/', '--allow-writes']),
+              _EXPECTED_BZR_SERVE_ARGV),
             ],
             vendor.calls)
 
@@ -3857,7 +3990,7 @@ class Test_SmartClientRequest(tests.TestCase):
                          output.getvalue())
         self.assertEqual(
             [('connect_ssh', 'a user', 'a pass', 'a host', 'a port',
-              ['bzr', 'serve', '--inet', '--directory=/', '--allow-writes']),
+              _EXPECTED_BZR_SERVE_ARGV),
             ],
             vendor.calls)
         self.assertRaises(errors.ConnectionReset, handler.read_response_tuple)
@@ -3871,10 +4004,10 @@ class Test_SmartClientRequest(tests.TestCase):
         # so we try again one time and succeed.
         self.assertEqual(
             [('connect_ssh', 'a user', 'a pass', 'a host', 'a port',
-              ['bzr', 'serve', '--inet', '--directory=/', '--allow-writes']),
+              _EXPECTED_BZR_SERVE_ARGV),
              ('close',),
              ('connect_ssh', 'a user', 'a pass', 'a host', 'a port',
-              ['bzr', 'serve', '--inet', '--directory=/', '--allow-writes']),
+              _EXPECTED_BZR_SERVE_ARGV),
             ],
             vendor.calls)
         self.assertEqual('bzr message 3 (bzr 1.6)\n' # protocol
@@ -3915,7 +4048,7 @@ class Test_SmartClientRequest(tests.TestCase):
         # the body stream. The next write fails, so we just stop.
         self.assertEqual(
             [('connect_ssh', 'a user', 'a pass', 'a host', 'a port',
-              ['bzr', 'serve', '--inet', '--directory=/', '--allow-writes']),
+              _EXPECTED_BZR_SERVE_ARGV),
              ('close',),
             ],
             vendor.calls)
@@ -3931,7 +4064,7 @@ class Test_SmartClientRequest(tests.TestCase):
         self.assertRaises(errors.ConnectionReset, smart_request._send, 3)
         self.assertEqual(
             [('connect_ssh', 'a user', 'a pass', 'a host', 'a port',
-              ['bzr', 'serve', '--inet', '--directory=/', '--allow-writes']),
+              _EXPECTED_BZR_SERVE_ARGV),
              ('close',),
             ],
             vendor.calls)
@@ -4088,6 +4221,19 @@ class TestChunkedBodyDecoder(tests.TestCase):
         self.assertEqual(None, decoder.read_next_chunk())
         self.assertEqual('', decoder.unused_data)
 
+    def test_length_split_after_decoded_chunk(self):
+        """A chunk length that starts in the same accept_bytes call as an
+        already decoded chunk is read correctly once the rest arrives.
+        """
+        decoder = protocol.ChunkedBodyDecoder()
+        decoder.accept_bytes('chunked\n3\naaa5')
+        self.assertEqual('aaa', decoder.read_next_chunk())
+        self.assertEqual(1, decoder.next_read_size())
+        decoder.accept_bytes('\nbbbbbEND\nexcess')
+        self.assertTrue(decoder.finished_reading)
+        self.assertEqual('bbbbb', decoder.read_next_chunk())
+        self.assertEqual('excess', decoder.unused_data)
+
     def test_excess_bytes(self):
         """Bytes after the chunked body are reported as unused bytes."""
         decoder = protocol.ChunkedBodyDecoder()